@@ -22,18 +22,112 @@
 """
 import argparse
 import atexit
+import functools
 # noinspection PyPackageRequirements
 import logging
 import pathlib
 import serial
 # noinspection PyPackageRequirements
+from serial.threaded import Protocol, ReaderThread
+# noinspection PyPackageRequirements
 from serial.tools import list_ports
 import signal
+import struct
 import sys
-# import threading
+import threading
 import time
 from python_banyan.banyan_base import BanyanBase
 
+# a picoboard packet is 9 big endian channel words, the first
+# carrying the firmware id. this format skips the id word and
+# unpacks the 8 sensor words. it is compiled once rather than
+# parsed on every unpack.
+PICOBOARD_SENSORS = struct.Struct('>2x8H')
+
+# ratios of the 0-100 report range to the 0-1023 analog input range
+ANALOG_SCALE = 100 / 1023
+INVERTED_ANALOG_SCALE = -100 / 1023
+
+# scaling of the inverted light sensor range above the low light threshold
+LIGHT_SCALE = 75 / 998
+
+
+class PicoboardProtocol(Protocol):
+    """
+    pyserial reader thread protocol for the picoboard.
+
+    Received bytes are accumulated until a full batch of packets
+    is available. Each batch is passed to the gateway's handle_packet
+    method and the picoboard is then polled for the next batch.
+    """
+
+    def __init__(self, gateway):
+        """
+        :param gateway: the PicoboardGateway instance
+        """
+        self.gateway = gateway
+        self.transport = None
+        self.buffer = bytearray()
+        self.last_received = time.monotonic()
+
+        # data_received runs in the reader thread and poll_if_idle
+        # in the main thread
+        self.lock = threading.Lock()
+
+    def connection_made(self, transport):
+        """
+        Send the first poll once the reader thread is running
+        :param transport: the ReaderThread instance
+        """
+        self.transport = transport
+        self.last_received = time.monotonic()
+        transport.write(self.gateway.poll_bytes)
+
+    def data_received(self, data):
+        """
+        Accumulate incoming bytes and dispatch complete batches
+        :param data: bytes read from the serial port
+        """
+        batch_bytes = self.gateway.batch_bytes
+        with self.lock:
+            self.last_received = time.monotonic()
+            self.buffer.extend(data)
+            while len(self.buffer) >= batch_bytes:
+                if not self.gateway.valid_batch(self.buffer):
+                    # out of step with the packet framing -
+                    # drop a byte until every packet in the
+                    # batch starts with a valid id word
+                    self.gateway.validated = False
+                    del self.buffer[0]
+                    continue
+                data_packet = bytes(self.buffer[:batch_bytes])
+                del self.buffer[:batch_bytes]
+                self.gateway.handle_packet(data_packet)
+                self.transport.write(self.gateway.poll_bytes)
+
+    def connection_lost(self, exc):
+        """
+        The serial port was closed or failed - stop the gateway.
+        The exception is re-raised by the gateway in the main thread.
+        :param exc: exception that stopped the reader, if any
+        """
+        self.gateway.reader_error = exc
+        self.gateway.stop_event.set()
+
+    def poll_if_idle(self, idle_time):
+        """
+        Discard any partial batch and poll again if nothing has
+        been received for idle_time seconds. The next packet must
+        then carry a valid firmware id again.
+        :param idle_time: seconds
+        """
+        with self.lock:
+            if time.monotonic() - self.last_received > idle_time:
+                self.buffer.clear()
+                self.gateway.validated = False
+                self.last_received = time.monotonic()
+                self.transport.write(self.gateway.poll_bytes)
+
 
 # noinspection PyMethodMayBeStatic
 class PicoboardGateway(BanyanBase):
@@ -47,15 +141,22 @@ class PicoboardGateway(BanyanBase):
 
     def __init__(self, back_plane_ip_address=None, subscriber_port='43125',
                  publisher_port='43124', process_name='PicoboardGateway',
-                 com_port=None, publisher_topic=None, log=False):
+                 com_port=None, publisher_topic=None, log=False,
+                 batch_size=1):
         """
         :param back_plane_ip_address:
         :param subscriber_port:
         :param publisher_port:
         :param process_name:
         :param com_port: picoboard com_port
+        :param batch_size: number of packets requested per poll.
+                           When greater than 1, the report is a list
+                           of sensor value lists, one per packet.
         """
 
+        if batch_size < 1:
+            raise ValueError('batch_size must be 1 or greater')
+
         # initialize parent
         super(PicoboardGateway, self).__init__(back_plane_ip_address, subscriber_port,
                                                publisher_port, process_name=process_name)
@@ -69,10 +170,23 @@ class PicoboardGateway(BanyanBase):
         self.baud_rate = 38400
         self.publisher_topic = publisher_topic
 
+        # set when the gateway is shutting down
+        self.stop_event = threading.Event()
+
         atexit.register(self.shutdown)
 
-        # place to receive data from picoboard
-        self.data_packet = None
+        # set once a packet with a valid firmware id has been received
+        self.validated = False
+
+        # the picoboard serial port, once opened
+        self.picoboard = None
+
+        # the pyserial reader thread and its protocol instance
+        self.reader = None
+        self.protocol = None
+
+        # exception that stopped the reader thread, if any
+        self.reader_error = None
 
         # data value positions in the data stream
         # generated by the picoboard
@@ -87,19 +201,41 @@ class PicoboardGateway(BanyanBase):
         # position 7 = sound  analog
         # position 8 = slider analog
 
-        # positional indices into data stream for analog sensors
-        # light is a special case and removed from this list
-        self.analog_sensor_list = [1, 2, 3, 5, 7, 8]
-
         # positional values for specific sensor types
         self.button_position = 4
         self.light_position = 6
-        self.sound_position = 7
 
         # indices that require data inversion.
         # light is left out of this list and handled separately.
         self.inverted_analog_list = [1, 2, 3, 5]
 
+        # scaling table for each position in the data stream.
+        # each entry is (input_low, scale), where scale is the
+        # ratio of the 0-100 output range to the input range.
+        # the id, button and light entries are placeholders and are not used.
+        self.scale_table = {}
+        for i in range(9):
+            if i in self.inverted_analog_list:
+                self.scale_table[i] = (1023, INVERTED_ANALOG_SCALE)
+            else:
+                self.scale_table[i] = (0, ANALOG_SCALE)
+
+        # the function that converts the raw value at each sensor position
+        # in the data stream to its reported value, in report order.
+        # analog entries have their input_low and scale bound in advance.
+        self.cook_table = []
+        for i, (input_low, scale) in self.scale_table.items():
+            if i == 0:
+                # the firmware id is not reported
+                continue
+            elif i == self.button_position:
+                self.cook_table.append(self.cook_button)
+            elif i == self.light_position:
+                self.cook_table.append(self.cook_light)
+            else:
+                self.cook_table.append(functools.partial(self.cook_analog,
+                                                         input_low, scale))
+
         # The payload data is built as a list of entries.
         # Indices are as follows:
         # index 0 = D  analog inverted logic
@@ -111,15 +247,25 @@ class PicoboardGateway(BanyanBase):
         # index 6 = sound  analog
         # index 7 = slider analog
 
-        self.payload = {'report': []}
+        # the report list is allocated once and its entries are
+        # overwritten for each packet. publish_payload serializes the
+        # payload before returning, so it is safe to reuse.
+        self.report_buffer = [0] * 8
+        self.payload = {'report': self.report_buffer}
 
         # poll request for picoboard data
         self.poll_byte = b'\x01'
 
+        # packets are requested and read batch_size at a time
+        self.batch_size = batch_size
+        self.batch_bytes = 18 * batch_size
+        self.poll_bytes = self.poll_byte * batch_size
+
         # if a com port was specified use it.
         if com_port:
             self.picoboard = serial.Serial(com_port, self.baud_rate,
                                            timeout=1, writeTimeout=0)
+            self.set_low_latency()
         # otherwise try to find a picoboard
         else:
             if self.find_the_picoboard():
@@ -131,66 +277,138 @@ class PicoboardGateway(BanyanBase):
 
         # allow thread time to start
         time.sleep(.2)
-        self.picoboard.write(self.poll_byte)
-
-        while True:
-            self.data_packet = None
-            # if there is data available from the picoboard
-            # retrieve 18 bytes - a full picoboard packet
-            cooked = None
-            try:
-                while self.picoboard.in_waiting != 18:
-                    # no data available, just kill some time
-                    try:
-                        time.sleep(.001)
-                    except (KeyboardInterrupt, serial.SerialException):
-                        sys.exit()
-            except (KeyboardInterrupt, serial.SerialException):
-                sys.exit()
-            self.data_packet = self.picoboard.read(18)
-            # get the channel number and data for the channel
-            for i in range(9):
-                # first channel reporting
-                if i == 0:
-                    pico_channel = (int(self.data_packet[0]) - 128) >> 3
-                    if pico_channel != 15 and pico_channel != 0:
-                        continue
-                    # check if the channel data is a value of 4
-                    pico_data = int(self.data_packet[1])
-                    if pico_data != 4:
-                        break
-                # pico_channel = self.channels[(int(self.data_packet[2 * i]) - 128) >> 3]
-                raw_sensor_value = ((int(self.data_packet[2 * i]) & 7) << 7) + int(self.data_packet[2 * i + 1])
-                if i == 0:  # id
-                    cooked = raw_sensor_value
-                elif i == self.light_position:
-                    if raw_sensor_value < 25:
-                        cooked = 100 - raw_sensor_value
-                    else:
-                        cooked = round((1023 - raw_sensor_value) * (75 / 998))
-                    cooked = self.analog_scaling(cooked, self.light_position)
-
-                elif i == self.sound_position:
-                    n = max(0, raw_sensor_value - 18)
-                    if n < 50:
-                        cooked = int(n / 2)
-                    else:
-                        cooked = 25 + min(75, int((n - 50) * (75 / 580)))
-                elif i == self.button_position:  # invert digital input
-                    cooked = int(not raw_sensor_value)
-
-                if i in self.analog_sensor_list:
-                    # scale for standard analog:
-                    cooked = self.analog_scaling(raw_sensor_value, i)
-
-                # don't add the firmware id to the payload -
-                # the extension does not need it.
-                if i != 0:
-                    self.payload['report'].append(cooked)
-
-            self.publish_payload(self.payload, self.publisher_topic)
-            self.payload = {'report': []}
-            self.picoboard.write(self.poll_byte)
+
+        # packets are received by a pyserial reader thread, which calls
+        # handle_packet for each complete batch and then polls again.
+        self.reader = ReaderThread(self.picoboard,
+                                   functools.partial(PicoboardProtocol, self))
+        self.reader.start()
+        _, self.protocol = self.reader.connect()
+
+        # wait for shutdown, waking once a second to re-poll
+        # a picoboard that has stopped answering.
+        try:
+            while not self.stop_event.wait(1):
+                self.protocol.poll_if_idle(1)
+        except KeyboardInterrupt:
+            sys.exit()
+
+        # errors in the reader thread, including those raised while
+        # handling a packet, are reported here rather than lost
+        if self.reader_error is not None:
+            raise self.reader_error
+
+    def handle_packet(self, data_packet):
+        """
+        Decode a complete batch of picoboard packets and publish it.
+        This does no serial I/O, so it can be driven by any reader
+        that delivers whole batches.
+
+        :param data_packet: batch_size * 18 bytes received from the picoboard
+        """
+        # decode through a view of the received bytes so that
+        # each packet in the batch is read in place, never copied.
+        packet_view = memoryview(data_packet)
+        if self.batch_size == 1:
+            if self.decode_packet(packet_view, report=self.report_buffer):
+                self.publish_payload(self.payload, self.publisher_topic)
+        else:
+            frames = [self.decode_packet(packet_view, offset)
+                      for offset in range(0, self.batch_bytes, 18)]
+            frames = [frame for frame in frames if frame is not None]
+            if frames:
+                self.publish_payload({'report': frames}, self.publisher_topic)
+
+    def decode_packet(self, packet, offset=0, report=None):
+        """
+        Decode and scale a single 18 byte picoboard packet.
+
+        The firmware id is only checked until the first valid packet
+        has been received. After that it is skipped without decoding,
+        since the reader checks the framing with valid_batch.
+
+        :param packet: bytes, or a memoryview of the bytes,
+                       received from the picoboard
+        :param offset: start of the packet within packet
+        :param report: an 8 entry list to overwrite with the values.
+                       A new list is allocated if it is None.
+        :return: The list of the 8 scaled sensor values in report order,
+                 or None if the packet does not carry a valid firmware id
+        """
+        if not self.validated:
+            if not self.valid_id(packet, offset):
+                return None
+            self.validated = True
+
+        # unpack the 8 sensor channel words of the packet in a single call.
+        # the high byte of each word carries the channel number in
+        # bits 3-6 and the 3 high bits of the sensor value in bits 0-2.
+        # don't decode the firmware id - the extension does not need it.
+        words = PICOBOARD_SENSORS.unpack_from(packet, offset)
+
+        if report is None:
+            report = [0] * 8
+
+        # convert each channel with the function for its position
+        for i, (cook, word) in enumerate(zip(self.cook_table, words)):
+            report[i] = cook(((word >> 1) & 0x380) + (word & 0xff))
+        return report
+
+    def valid_id(self, packet, offset=0):
+        """
+        Check the first word of a packet for the picoboard firmware id.
+        The id is reported on channel 0 or 15 and must be a value of 4.
+
+        :param packet: bytes, bytearray or memoryview
+        :param offset: start of the packet within packet
+        :return: True if the packet starts with a valid firmware id
+        """
+        pico_channel = (packet[offset] - 128) >> 3
+        return (pico_channel == 15 or pico_channel == 0) and \
+            packet[offset + 1] == 4
+
+    def valid_batch(self, packet):
+        """
+        Framing check made on every batch by the reader.
+        Each packet in the batch must start with a valid firmware id,
+        checking both the channel and the id value.
+
+        :param packet: batch_size * 18 bytes, bytearray or memoryview
+        :return: True if every packet starts with a valid firmware id
+        """
+        for offset in range(0, self.batch_bytes, 18):
+            if not self.valid_id(packet, offset):
+                return False
+        return True
+
+    def cook_button(self, value):
+        """
+        Invert the digital button input
+        :param value: raw button value
+        :return: 1 if the button is pressed, otherwise 0
+        """
+        return int(not value)
+
+    def cook_light(self, value):
+        """
+        Convert the inverted light sensor value to 0-100.
+        :param value: raw light value
+        :return: A value between 0 and 100
+        """
+        if value < 25:
+            return 100 - value
+        return round((1023 - value) * LIGHT_SCALE)
+
+    def cook_analog(self, input_low, scale, value):
+        """
+        Scale the normal analog input range of 0-1023 to 0-100,
+        with the table entry pre-bound
+        :param input_low: input_low from the scale table
+        :param scale: scale from the scale table
+        :param value: raw analog value
+        :return: A value scaled between 0 and 100
+        """
+        return round((value - input_low) * scale)
 
     def find_the_picoboard(self):
         """
@@ -212,61 +430,49 @@ class PicoboardGateway(BanyanBase):
                                                    timeout=1, writeTimeout=0)
                 except (KeyboardInterrupt, serial.SerialException):
                     sys.exit(0)
+                # a responding picoboard answers a poll within a few
+                # milliseconds, so a single read with a short timeout
+                # is enough to decide whether this is the board.
+                self.picoboard.timeout = .5
                 try:
                     self.picoboard.write(self.poll_byte)
-                    time.sleep(.2)
+                    data_packet = self.picoboard.read(18)
                 except (KeyboardInterrupt, serial.SerialException):
                     sys.exit()
 
-                try_count = 10
-                while try_count:
-                    num_bytes = self.picoboard.in_waiting
-                    if num_bytes < 18:
-                        try:
-                            self.picoboard.write(self.poll_byte)
-                            time.sleep(.2)
-                            try_count -= 1
-                            if not try_count:
-                                # return False
-                                continue
-                        except (KeyboardInterrupt, serial.SerialException):
-                            sys.exit()
-                    # check the first 2 bytes for channel 0 or f
-                    else:
-                        data_packet = self.picoboard.read(18)
-                        pico_channel = (int(data_packet[0]) - 128) >> 3
-                        if pico_channel != 15 and pico_channel != 0:
-                            continue
-                        # check if the channel data is a value of 4
-                        pico_data = int(data_packet[1])
-
-                        if pico_data != 4:
-                            return False
-                        else:
-                            return True
-
-    def analog_scaling(self, value, index):
-        """
-        scale the normal analog input range of 0-1023 to 0-100
-        :param value:
-        :param index: sensor index value within data stream
-        :return: A value scaled between 0 and 100
+                if len(data_packet) == 18 and self.valid_id(data_packet):
+                    self.picoboard.timeout = 1
+                    self.set_low_latency()
+                    return True
+
+                # not a picoboard - try the next port
+                self.picoboard.close()
+        return False
+
+    def set_low_latency(self):
         """
-        if index == self.light_position:
-            input_low = 0
-            input_high = 100
-        elif index in self.inverted_analog_list:  # the light channel
-            input_low = 1023
-            input_high = 0
-        else:
-            input_low = 0
-            input_high = 1023
+        The FTDI USB serial chip holds received data for up to 16 ms
+        before passing it to the host. On Linux, lower the latency timer
+        to 1 ms and request low latency mode from the serial driver.
+        This is a no-op on other platforms or for non FTDI devices.
+        """
+        if not sys.platform.startswith('linux'):
+            return
 
-        new_value_low = 0
-        new_value_high = 100
+        # resolve /dev/serial/by-id style links to the ttyUSB device
+        device_name = pathlib.Path(self.picoboard.port).resolve().name
+        latency_timer = pathlib.Path('/sys/bus/usb-serial/devices',
+                                     device_name, 'latency_timer')
+        try:
+            latency_timer.write_text('1')
+        except OSError:
+            # not an FTDI device or not enough permissions
+            pass
 
-        return round(((value - input_low) * ((new_value_high - new_value_low) / (input_high - input_low))) +
-                     new_value_low)
+        try:
+            self.picoboard.set_low_latency_mode(True)
+        except (AttributeError, OSError, ValueError):
+            pass
 
     def my_handler(self, xtype, value, tb):
         """
@@ -283,9 +489,13 @@ class PicoboardGateway(BanyanBase):
         Exit gracefully
 
         """
-        self.picoboard.reset_input_buffer()
-        self.picoboard.reset_output_buffer()
-        self.picoboard.close()
+        self.stop_event.set()
+        if self.reader is not None and self.reader.is_alive():
+            self.reader.stop()
+        if self.picoboard is not None and self.picoboard.is_open:
+            self.picoboard.reset_input_buffer()
+            self.picoboard.reset_output_buffer()
+            self.picoboard.close()
         sys.exit(0)
 
 
@@ -295,6 +505,8 @@ def picoboard_gateway():
                         help="None or IP address used by Back Plane")
     parser.add_argument("-c", dest="com_port", default="None",
                         help="Use this COM port instead of auto discovery")
+    parser.add_argument("-k", dest="batch_size", default=1, type=int,
+                        help="Number of picoboard packets read per poll")
     parser.add_argument("-l", dest="log", default="False",
                         help="Set to True to turn logging on.")
     parser.add_argument("-n", dest="process_name",
@@ -309,11 +521,15 @@ def picoboard_gateway():
 
     args = parser.parse_args()
 
+    if args.batch_size < 1:
+        parser.error('-k batch size must be 1 or greater')
+
     kw_options = {
         'publisher_port': args.publisher_port,
         'subscriber_port': args.subscriber_port,
         'process_name': args.process_name,
-        'publisher_topic': args.publisher_topic
+        'publisher_topic': args.publisher_topic,
+        'batch_size': args.batch_size
     }
 
     if args.back_plane_ip_address != 'None':
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
+import threading
+
 import pigpio
-import time
 
 # based on an example provided with the pigpio library
 
@@ -26,7 +27,8 @@ class Sonar:
         self._trig = trigger
         self._echo = echo
 
-        self._ping = False
+        # set by the echo callback when a round trip has been timed
+        self._ping = threading.Event()
         self._high = None
         self._time = None
 
@@ -38,7 +40,7 @@ class Sonar:
         pi.set_mode(self._trig, pigpio.OUTPUT)
         pi.set_mode(self._echo, pigpio.INPUT)
 
-        self._cb = pi.callback(self._trig, pigpio.EITHER_EDGE, self._cbf)
+        self._trig_cb = pi.callback(self._trig, pigpio.EITHER_EDGE, self._cbf)
         self._cb = pi.callback(self._echo, pigpio.EITHER_EDGE, self._cbf)
 
         self._inited = True
@@ -54,9 +56,9 @@ class Sonar:
                     self._high = tick
                 else:
                     if self._high is not None:
-                        self._time = tick - self._high
+                        self._time = pigpio.tickDiff(self._high, tick)
                         self._high = None
-                        self._ping = True
+                        self._ping.set()
 
     def read(self):
         """
@@ -64,15 +66,16 @@ class Sonar:
         of microseconds for the sonar round-trip.
 
         round trip cms = round trip time / 1000000.0 * 34030
+
+        The edge times are the pigpio hardware ticks delivered to the
+        callbacks, so the calling thread simply blocks until the echo
+        falls instead of polling.
         """
         if self._inited:
-            self._ping = False
+            self._ping.clear()
             self.pi.gpio_trigger(self._trig)
-            start = time.time()
-            while not self._ping:
-                if (time.time() - start) > 5.0:
-                    return 20000
-                time.sleep(0.001)
+            if not self._ping.wait(5.0):
+                return 20000
             return self._time
         else:
             return None
@@ -84,6 +87,7 @@ class Sonar:
         """
         if self._inited:
             self._inited = False
+            self._trig_cb.cancel()
             self._cb.cancel()
             self.pi.set_mode(self._trig, self._trig_mode)
             self.pi.set_mode(self._echo, self._echo_mode)